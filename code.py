@@ -3,7 +3,6 @@
 #
 # See NOTES.md for documentation links
 #
-import array
 from audiobusio import I2SOut
 import audiocore
 from board import (
@@ -20,6 +19,7 @@ from pwmio import PWMOut
 import struct
 import supervisor
 import time
+from ulab import numpy as np
 
 from adafruit_tlv320 import TLV320DAC3100
 
@@ -27,6 +27,29 @@ from adafruit_tlv320 import TLV320DAC3100
 # I2S MCLK clock frequency
 MCLK_HZ = const(15_000_000)
 
+# Set this to True to print how long each step of load_au_file() takes
+_DEBUG_TIMING = const(False)
+
+# Not all ulab builds include np.take()
+_HAS_TAKE = hasattr(np, 'take')
+
+# Reusable buffer for reading AU file headers
+_AU_HEADER = bytearray(24)
+
+# Max number of samples to decode per decode_mulaw() call. ulab's np.take()
+# allocates a temporary size_t index array (4 bytes per sample) as long as
+# its indices, so this bounds that allocation to 32 kB.
+_DECODE_SLICE = const(8192)
+
+# Free heap (bytes) to leave beyond the read buffer when load_au_file() reads
+# a whole file at once. This covers np.take()'s 32 kB index array for one
+# _DECODE_SLICE of samples, plus 4 kB for small allocations made during
+# decoding and for the caller to wrap the result in a RawSample.
+_WHOLE_FILE_HEADROOM = const(4 * 8192 + 4096)
+
+# Cached µ-law lookup table (see load_mulaw_lut())
+_MULAW_LUT = None
+
 
 def init_display(width, height, color_depth):
     # Initialize the picodvi display
@@ -47,8 +70,10 @@ def init_display(width, height, color_depth):
     return display
 
 
-def configure_dac(i2c, sample_rate, mclk_hz):
+def configure_dac(i2c, sample_rate, mclk_hz, wait=True):
     # Configure TLV320DAC (this requires a separate 15 MHz PWMOut to MCLK)
+    # Use wait=False to skip the volume ramp-up delay if the caller has other
+    # work to do in the meantime.
 
     # 1. Initialize DAC (this includes a soft reset and sets minimum volumes)
     dac = TLV320DAC3100(i2c)
@@ -72,68 +97,150 @@ def configure_dac(i2c, sample_rate, mclk_hz):
     dac.configure_clocks(sample_rate=sample_rate, mclk_freq=MCLK_HZ)
 
     # 4. Wait for power-on volume ramp-up to finish
-    time.sleep(0.35)
+    if wait:
+        time.sleep(0.35)
     return dac
 
 
-def load_au_file(filename):
+def read_au_header(f):
+    # Read AU file header (6 big-endian 32-bit unsigned integers, 24 bytes)
+    # and return the (offset, size) of the sample data
+    if f.readinto(_AU_HEADER) != 24:
+        raise ValueError("file is not a valid AU file")
+
+    # Make sure samples are 8000 Hz, mono, µ-law encoded
+    magic, offset, size, encoding, rate, channels = struct.unpack_from(
+        ">6I", _AU_HEADER)
+    if magic != 0x2e736e64:
+        raise ValueError("Not an AU file (magic bytes are wrong)")
+    if encoding != 1:
+        raise ValueError("AU file sample encoding is not u-law")
+    if rate != 8000 or channels != 1:
+        raise ValueError("AU file is not 8000 Hz mono")
+    if size == 0xffffffff:
+        raise ValueError("AU file with header.size=-1 is not supported")
+    return offset, size
+
+
+def load_mulaw_lut():
+    # Load the precomputed µ-law lookup table (see make_mulaw_lut.py) as an
+    # int16 ndarray that can be indexed with raw µ-law bytes. The table only
+    # gets read from the file once, then it is cached for later calls.
+    global _MULAW_LUT
+    if _MULAW_LUT is None:
+        lut = bytearray(512)
+        with open("mulaw_lut.bin", 'rb') as f:
+            if f.readinto(lut) != 512:
+                raise ValueError("mulaw_lut.bin is not a valid u-law LUT")
+        lut = np.frombuffer(lut, dtype=np.int16)
+        # Spot check against the G.711 table. Raw bytes 0x00-0x7F decode as
+        # negative, 0x80-0xFF as positive, and 0x7F and 0xFF are both zero.
+        if (lut[0x00] != -32124 or lut[0x7F] != 0 or lut[0x80] != 32124
+                or lut[0xFF] != 0):
+            raise ValueError("mulaw_lut.bin is not a valid u-law LUT")
+        _MULAW_LUT = lut
+    return _MULAW_LUT
+
+
+def decode_mulaw(lut, src, dst):
+    # Decode µ-law bytes from the uint8 ndarray src into the ndarray dst.
+    # Using ulab's np.take() to do the LUT lookups is much faster than a
+    # Python loop over samples, but some ulab builds leave out np.take(). In
+    # that case, fall back to a loop over memoryviews, which is the fastest
+    # way to do per-sample indexing without ulab's per-item overhead.
+    if _HAS_TAKE:
+        np.take(lut, src, out=dst)
+        return
+    src_mv = memoryview(src)
+    dst_mv = memoryview(dst)
+    lut_mv = memoryview(lut)
+    for k in range(len(src_mv)):
+        dst_mv[k] = lut_mv[src_mv[k]]
+
+
+def load_au_file(filename, pcm_bits=16):
+    # Decode an 8 kHz mono µ-law AU file into an LPCM ndarray.
+    # pcm_bits=16 gives int16 samples with the full µ-law dynamic range.
+    # pcm_bits=8 gives int8 samples (the high byte of each int16 sample),
+    # which halves the buffer size at the cost of quieter details.
+    if pcm_bits not in (8, 16):
+        raise ValueError("pcm_bits must be 8 or 16")
     with open(filename, 'rb') as f:
-        # Read AU file header (6 big-endian 32-bit unsigned integers, 24 bytes)
-        header = f.read(24)
-        if len(header) != 24:
-            raise ValueError("file is not a valid AU file")
-
-        # Make sure samples are 8000 Hz, mono, µ-law encoded
-        magic, offset, size, encoding, rate, channels = struct.unpack(
-            ">6I", header)
-        if magic != 0x2e736e64:
-            raise ValueError("Not an AU file (magic bytes are wrong)")
-        if encoding != 1:
-            raise ValueError("AU file sample encoding is not u-law")
-        if rate != 8000 or channels != 1:
-            raise ValueError("AU file is not 8000 Hz mono")
-        if size == 0xffffffff:
-            raise ValueError("AU file with header.size=-1 is not supported")
+        offset, size = read_au_header(f)
 
         t0 = time.monotonic()
-        print("t = 0.000")
 
-        # Pre-allocate output buffer (16-bit LPCM)
-        pcm = array.array("h", bytearray(size * 2))
+        # Pre-allocate output buffer (16-bit or 8-bit LPCM)
+        dtype = np.int16 if pcm_bits == 16 else np.int8
+        pcm = np.zeros(size, dtype=dtype)
         t1 = time.monotonic()
-        print(f"delta-t = {t1-t0:.3f}: pre-allocated PCM buffer")
 
-        # Generate µ-law lookup table
-        lut = array.array("h", bytearray(512))  # 'h' = int16
-        for i in range(256):
-            u = (~i) & 0xFF
-            sign = u & 0x80
-            exp = (u >> 4) & 0x07
-            mant = u & 0x0F
-            s = ((mant << 3) + 0x84) << exp
-            s -= 0x84
-            lut[i] = -s if sign else s
-        lut_mv = memoryview(lut)
+        # Load the µ-law lookup table
+        lut_np = load_mulaw_lut()
+        if pcm_bits == 8:
+            # Keep just the high (odd) bytes of the little-endian int16 values
+            lut_np = np.array(np.frombuffer(lut_np, dtype=np.int8)[1::2],
+                dtype=np.int8)
         t2 = time.monotonic()
-        print(f"delta-t = {t2-t1:.3f}: generated u-law LUT")
 
         # Seek to start of audio data
         f.seek(offset)
 
-        # Decode audio sample data in 1 kB chunks
-        i = 0
-        while i < size:
-            data = f.read(min(1024, size - i))
-            if not data:
+        # If there's enough free RAM, read all the samples with one big read,
+        # then decode them in slices. Otherwise, read and decode in chunks.
+        # Since gc.mem_free() counts all free heap rather than the largest
+        # free block, the allocation can still fail if the heap is fragmented.
+        gc.collect()
+        raw = None
+        if gc.mem_free() > size + _WHOLE_FILE_HEADROOM:
+            try:
+                raw = bytearray(size)
+                raw_np = np.frombuffer(raw, dtype=np.uint8)
+            except MemoryError:
+                raw = None
+        if raw is not None:
+            if f.readinto(raw) != size:
                 raise ValueError("Truncated AU file data")
-            data_mv = memoryview(data)
-            for j in range(len(data_mv)):
-                pcm[i + j] = lut_mv[data_mv[j]]
-            i += len(data_mv)
+            for i in range(0, size, _DECODE_SLICE):
+                j = min(i + _DECODE_SLICE, size)
+                decode_mulaw(lut_np, raw_np[i:j], pcm[i:j])
+            del raw, raw_np
+        else:
+            # Decode audio sample data in 8 kB chunks (or 4 kB if RAM is
+            # tight). The chunks get read into a reusable scratch buffer, and
+            # decode_mulaw() writes directly into the PCM buffer, to avoid
+            # heap churn. Each chunk needs 5 bytes of free RAM per sample:
+            # 1 for the scratch buffer plus 4 for np.take()'s index array.
+            chunk = _DECODE_SLICE
+            if gc.mem_free() <= 5 * _DECODE_SLICE:
+                chunk = _DECODE_SLICE // 2
+            scratch = bytearray(chunk)
+            scratch_mv = memoryview(scratch)
+            scratch_np = np.frombuffer(scratch, dtype=np.uint8)
+            i = 0
+            while i < size:
+                n = f.readinto(scratch_mv[:min(chunk, size - i)])
+                if not n:
+                    raise ValueError("Truncated AU file data")
+                decode_mulaw(lut_np, scratch_np[:n], pcm[i:i + n])
+                i += n
+            del scratch, scratch_mv, scratch_np
         t3 = time.monotonic()
+
+    # Print timing info after the timed steps so printing does not skew it
+    if _DEBUG_TIMING:
+        print("t = 0.000")
+        print(f"delta-t = {t1-t0:.3f}: pre-allocated PCM buffer")
+        print(f"delta-t = {t2-t1:.3f}: loaded u-law LUT")
         print(f"delta-t = {t3-t2:.3f}: decoded u-law samples to PCM")
 
-        return pcm
+    # Reclaim the read buffers deleted above before the caller allocates more
+    # stuff. The 8-bit LUT is a private copy, so drop it too. (The int16 LUT
+    # stays cached for next time.)
+    if pcm_bits == 8:
+        del lut_np
+    gc.collect()
+    return pcm
 
 
 def run():
@@ -162,14 +269,18 @@ Fruit Jam AU file player (8kHz 8-bit mono u-law)
     # Set up 15 MHz MCLK PWM clock output for less hiss and distortion
     mclk_pwm = PWMOut(I2S_MCLK, frequency=MCLK_HZ, duty_cycle=2**15)
 
-    # Initialize DAC for 8 kHz sample rate
-    dac = configure_dac(i2c, 8000, MCLK_HZ)
-    time.sleep(1)  # ensure volume has stabilized
+    # Initialize DAC for 8 kHz sample rate. The AU file gets loaded while
+    # the DAC's volume ramps up, rather than waiting first and loading after.
+    dac = configure_dac(i2c, 8000, MCLK_HZ, wait=False)
+    t0 = time.monotonic()
 
     # Load 8-bit µ-law samples from .au file into a 16-bit LPCM buffer
     pcm = load_au_file("demo.au")
+    # pcm = load_au_file("demo.au", pcm_bits=8)  # Use this to save RAM
     au = audiocore.RawSample(pcm, channel_count=1, sample_rate=8000)
-    play_time = len(pcm) / 8000  # length of audio clip in seconds
+
+    # Ensure volume has stabilized (0.35s ramp-up plus 1s of margin)
+    time.sleep(max(0, 1.35 - (time.monotonic() - t0)))
 
     # Load 16-bit WAV version
     wav = audiocore.WaveFile("demo_16bit.wav")
@@ -180,11 +291,13 @@ Fruit Jam AU file player (8kHz 8-bit mono u-law)
         print("\rPlaying 8-bit AU ...  ", end='')
         time.sleep(0.5)
         audio.play(au)
-        time.sleep(play_time + 1)
+        while audio.playing:
+            time.sleep(0.05)
         print("\rPlaying 16-bit WAV ...", end='')
         time.sleep(0.5)
         audio.play(wav)
-        time.sleep(play_time + 1)
+        while audio.playing:
+            time.sleep(0.05)
 
 
 # Run the demo
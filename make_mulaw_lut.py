@@ -0,0 +1,28 @@
+# SPDX-License-Identifier: MIT
+# SPDX-FileCopyrightText: Copyright 2026 Sam Blenny
+"""
+Generate mulaw_lut.bin, a G.711 µ-law to 16-bit LPCM decode table.
+
+The table has 256 little-endian int16 values (512 bytes) which code.py reads
+into RAM at load time. Index the table with the raw µ-law byte from an AU
+file. You can run this manually as `make mulaw_lut.bin`.
+"""
+import struct
+
+
+OUTFILE = 'mulaw_lut.bin'
+
+lut = []
+for i in range(256):
+    u = (~i) & 0xFF
+    sign = u & 0x80
+    exp = (u >> 4) & 0x07
+    mant = u & 0x0F
+    s = ((mant << 3) + 0x84) << exp
+    s -= 0x84
+    # Branchless negate: m is -1 if sign bit is set, else 0
+    m = -(sign >> 7)
+    lut.append((s ^ m) - m)
+
+with open(OUTFILE, 'wb') as f:
+    f.write(struct.pack('<256h', *lut))